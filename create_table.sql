@@ -3,14 +3,14 @@ CREATE EXTENSION citext;
 CREATE TABLE public.ethtxs
 (
     "time" integer,
-    txfrom citext COLLATE pg_catalog."default",
-    txto citext COLLATE pg_catalog."default",
+    txfrom bytea,
+    txto bytea,
     gas bigint,
     gasprice bigint,
     block integer,
-    txhash citext COLLATE pg_catalog."default",
+    txhash bytea,
     value numeric,
-    contract_to citext COLLATE pg_catalog."default",
+    contract_to bytea,
     contract_value citext COLLATE pg_catalog."default",
     status boolean,
     UNIQUE(txhash)
@@ -30,17 +30,17 @@ CREATE INDEX block_index
 
 CREATE INDEX contract_to_index
     ON public.ethtxs USING btree
-    (contract_to COLLATE pg_catalog."default")
+    (contract_to)
     TABLESPACE pg_default;
 
 CREATE INDEX txfrom_index
     ON public.ethtxs USING btree
-    (txfrom COLLATE pg_catalog."default")
+    (txfrom)
     TABLESPACE pg_default;
 
 CREATE INDEX txto_index
     ON public.ethtxs USING btree
-    (txto COLLATE pg_catalog."default")
+    (txto)
     TABLESPACE pg_default;
 
 CREATE VIEW max_block as 
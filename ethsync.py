@@ -9,10 +9,24 @@
 # v2.1
 
 from os import environ
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import csv
+import io
+import json
 from web3 import Web3
+from web3.datastructures import AttributeDict
 from web3.middleware import geth_poa_middleware
+from hexbytes import HexBytes
+from queue import Empty, Queue
+from threading import Event, Thread
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+import requests
 import time
+import websockets
 import sys
 import logging
 
@@ -25,10 +39,32 @@ userpass = environ.get("DB_PASS")
 
 startBlock = environ.get("START_BLOCK") or "1"
 confirmationBlocks = environ.get("CONFIRMATIONS_BLOCK") or "0"
-reorg_blocks = environ.get("CONFIRMATIONS_BLOCK") or 10
+reorg_blocks = int(environ.get("CONFIRMATIONS_BLOCK") or 10)
 nodeUrl = environ.get("ETH_URL")
 pollingPeriod = environ.get("PERIOD") or "20"
 logFile = environ.get("LOG_FILE")
+batchSize = int(environ.get("BATCH_SIZE") or "20")
+# Selector of ERC20 transfer(address,uint256), first 4 bytes of the tx input
+transferSelector = bytes.fromhex("a9059cbb")
+# Blocks per eth_getBlockReceipts batch, smaller than batchSize since every
+# block answers with all its receipts and logs
+blockReceiptsBatchSize = 5
+# Number of receipts requested at once when eth_getBlockReceipts is not supported
+receiptWorkers = 16
+# Number of fetched blocks waiting to be written to the database
+prefetchBlocks = 32
+# Columns of public.ethtxs in the order of the rows built by insertTxsFromBlock
+txColumns = "time, txfrom, txto, value, gas, gasprice, block, txhash, contract_to, contract_value, status"
+# execute_values sends one multi-row statement per page of rows, so the server
+# parses and plans it once per page rather than once per transaction.
+#
+# Transactions already stored (retries, resyncs after a reorg) are skipped.
+insertTxsQuery = f"INSERT INTO public.ethtxs({txColumns}) VALUES %s ON CONFLICT (txhash) DO NOTHING"
+# COPY has no conflict handling: a duplicate txhash aborts the whole chunk.
+# It is only used for backfill ranges past the last stored block.
+copyTxsQuery = f"COPY public.ethtxs({txColumns}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (contract_value))"
+# Index lagging behind the chain by more blocks than this is loaded with COPY
+backfillThreshold = 10000
 
 if dbname == None:
     print("Add postgre database in env var DB_NAME")
@@ -73,20 +109,53 @@ logger.addHandler(lfh)
 try:
     logger.info("Trying to connect to " + dbname + " database…")
     pg_connection_dict = {"dbname": dbname, "user": username, "password": userpass}
-    conn = psycopg2.connect(**pg_connection_dict)
+    # Connections are kept open for the whole run instead of reconnecting each period
+    pool = psycopg2.pool.ThreadedConnectionPool(1, 4, **pg_connection_dict)
+    conn = pool.getconn()
     conn.autocommit = True
     logger.info("Connected to the database")
 except:
     logger.error("Unable to connect to database")
     exit(1)
 
+# Best block in index, tracked while syncing and read again only at start or
+# after a reconnect
+def readMaxBlockInDb(cur):
+    cur.execute("SELECT Max(block) from public.ethtxs")
+    maxblock = cur.fetchone()[0]
+    # On first start, we index transactions from a block number you indicate
+    if maxblock is None:
+        maxblock = int(startBlock)
+    return maxblock
+
+
+# Borrows a connection from the pool. A connection dropped by the server (e.g.
+# on a Postgres restart) only fails once used, so it is probed and replaced.
+# Also returns whether it was replaced
+def getLiveConnection():
+    conn = pool.getconn()
+    try:
+        # Blocks are written in transactions of batchSize blocks
+        conn.autocommit = False
+        with conn.cursor() as probe:
+            probe.execute("SELECT 1")
+        return conn, False
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        logger.warning("Database connection was lost, reconnecting")
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+        conn.autocommit = False
+        return conn, True
+
+
 # Delete last block as it may be not imported in full
 cur = conn.cursor()
 cur.execute(
     "DELETE FROM public.ethtxs WHERE block = (SELECT Max(block) from public.ethtxs)"
 )
+maxblockindb = readMaxBlockInDb(cur)
 cur.close()
-conn.close()
+pool.putconn(conn)
 
 # Wait for the node to be in sync before indexing
 while web3.eth.syncing != False:
@@ -97,57 +166,257 @@ while web3.eth.syncing != False:
 
 logger.info("Ethereum node is synced.")
 
-# Adds all transactions from Ethereum block
-def insertTxsFromBlock(block):
+# Seconds to wait for the node before a request fails, as web3 HTTPProvider does
+rpcTimeout = 10
+
+# Keeps http connections to the node alive between requests, with a
+# connection for each receipt worker
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=receiptWorkers))
+session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=receiptWorkers))
+
+# Sends one JSON-RPC request per params item and returns the results in order.
+# Over http all requests of a slice (batchSize items by default) go in a single
+# batch (one round-trip), other providers fall back to one request per item
+def rpcBatch(method, paramsList, sliceSize=None):
+    sliceSize = sliceSize or batchSize
+    results = []
+    for sliceStart in range(0, len(paramsList), sliceSize):
+        paramsSlice = paramsList[sliceStart : sliceStart + sliceSize]
+        if nodeUrl.startswith("http"):
+            payload = [
+                {"jsonrpc": "2.0", "id": i, "method": method, "params": params}
+                for i, params in enumerate(paramsSlice)
+            ]
+            response = session.post(nodeUrl, json=payload, timeout=rpcTimeout)
+            response.raise_for_status()
+            responses = response.json()
+            # A node rejecting the whole batch answers with a single error object
+            if not isinstance(responses, list):
+                raise ValueError(responses.get("error", responses))
+            responses = sorted(responses, key=lambda r: r["id"])
+        else:
+            responses = [
+                web3.provider.make_request(method, params) for params in paramsSlice
+            ]
+        for response in responses:
+            if "error" in response:
+                raise ValueError(response["error"])
+            results.append(response["result"])
+    return results
+
+
+# Sends one JSON-RPC request per params item concurrently over http, which many
+# nodes answer faster than a single large batch. Other providers use rpcBatch
+def rpcParallel(method, paramsList):
+    if not nodeUrl.startswith("http"):
+        return rpcBatch(method, paramsList)
+    with ThreadPoolExecutor(max_workers=receiptWorkers) as executor:
+        return list(executor.map(lambda params: rpcCall(method, params), paramsList))
+
+
+def rpcCall(method, params):
+    payload = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params}
+    response = session.post(nodeUrl, json=payload, timeout=rpcTimeout)
+    response.raise_for_status()
+    response = response.json()
+    if "error" in response:
+        raise ValueError(response["error"])
+    return response["result"]
+
+
+# Raw JSON-RPC objects are converted to the same shape web3 getBlock
+# and getTransactionReceipt return, except addresses which are kept as
+# raw bytes to be stored in bytea columns
+def formatTransaction(rawTrans):
+    return AttributeDict(
+        {
+            "hash": HexBytes(rawTrans["hash"]),
+            "from": bytes.fromhex(rawTrans["from"][2:]),
+            "to": bytes.fromhex(rawTrans["to"][2:]) if rawTrans["to"] else None,
+            "value": int(rawTrans["value"], 16),
+            "gasPrice": int(rawTrans["gasPrice"], 16),
+            "input": bytes.fromhex(rawTrans["input"][2:]),
+        }
+    )
+
+
+def formatBlock(rawBlock):
+    return AttributeDict(
+        {
+            "number": int(rawBlock["number"], 16),
+            "timestamp": int(rawBlock["timestamp"], 16),
+            "hash": HexBytes(rawBlock["hash"]),
+            "parentHash": HexBytes(rawBlock["parentHash"]),
+            "transactions": [formatTransaction(t) for t in rawBlock["transactions"]],
+        }
+    )
+
+
+def formatReceipt(rawReceipt):
+    status = rawReceipt.get("status")
+    return AttributeDict(
+        {
+            "transactionHash": HexBytes(rawReceipt["transactionHash"]),
+            "blockHash": HexBytes(rawReceipt["blockHash"]),
+            "status": int(status, 16) if status is not None else None,
+            "gasUsed": int(rawReceipt["gasUsed"], 16),
+        }
+    )
+
+
+# Only ETH transfers and ERC20 token transfers are stored in the index.
+# The filter works on the transaction itself, not on Transfer logs fetched
+# with eth_getLogs: failed transfers emit no log but are stored with their
+# status, and logs also report transfers made by other contract calls
+def isIndexedTx(trans):
+    return trans["value"] != 0 or trans["input"][:4] == transferSelector
+
+
+# Times a chunk is fetched before giving up on receipts that don't match its blocks
+fetchAttempts = 3
+
+# Set to False once the node answers eth_getBlockReceipts with "method not found"
+blockReceiptsSupported = True
+methodNotFoundCode = -32601
+
+# Fetches blocks with their transactions and all the receipts for them.
+# If the chain reorganised between the block and receipt requests, some
+# receipts are missing or belong to another block: the chunk is fetched again
+def fetchBlocks(heights):
+    for attempt in range(fetchAttempts):
+        blocks, receiptsByHash = fetchBlocksAndReceipts(heights)
+        missing = [
+            trans["hash"].hex()
+            for block in blocks
+            for trans in block.transactions
+            if isIndexedTx(trans)
+            and (
+                trans["hash"] not in receiptsByHash
+                or receiptsByHash[trans["hash"]]["blockHash"] != block["hash"]
+            )
+        ]
+        if not missing:
+            return blocks, receiptsByHash
+        logger.warning(
+            f"Receipts of {len(missing)} transactions don't match blocks {heights[0]} to {heights[-1]}, fetching them again"
+        )
+    raise ValueError(f"Receipts missing for transactions {missing}")
+
+
+# Receipts come from eth_getBlockReceipts (one request per block, by the hash
+# of the fetched block) when the node supports it, else from concurrent
+# eth_getTransactionReceipt per transaction
+def fetchBlocksAndReceipts(heights):
+    global blockReceiptsSupported
+    rawBlocks = rpcBatch("eth_getBlockByNumber", [[hex(h), True] for h in heights])
+    blocks = [formatBlock(rawBlock) for rawBlock in rawBlocks]
+    rawReceipts = None
+    if blockReceiptsSupported:
+        try:
+            blockReceipts = rpcBatch(
+                "eth_getBlockReceipts",
+                [[block["hash"].hex()] for block in blocks],
+                sliceSize=blockReceiptsBatchSize,
+            )
+            # Null for a block hash the node no longer knows after a reorganisation
+            rawReceipts = [r for receipts in blockReceipts if receipts for r in receipts]
+        except ValueError as e:
+            # Other errors (rate limits, response too large…) are not a reason
+            # to give up on eth_getBlockReceipts for the rest of the run
+            error = e.args[0] if e.args else None
+            if not isinstance(error, dict) or error.get("code") != methodNotFoundCode:
+                raise
+            logger.warning(
+                f"Node does not support eth_getBlockReceipts ({e}), fetching receipts per transaction"
+            )
+            blockReceiptsSupported = False
+    if rawReceipts is None:
+        # Receipts of transactions that won't be indexed are not requested
+        txHashes = [
+            trans["hash"].hex()
+            for block in blocks
+            for trans in block.transactions
+            if isIndexedTx(trans)
+        ]
+        rawReceipts = rpcParallel("eth_getTransactionReceipt", [[h] for h in txHashes])
+    # Receipts of transactions no longer in the chain are null
+    receipts = [formatReceipt(r) for r in rawReceipts if r is not None]
+    receiptsByHash = {r["transactionHash"]: r for r in receipts}
+    return blocks, receiptsByHash
+
+
+# Runs in a background thread so that fetching blocks from the node overlaps
+# with writing them to the database. Every block is queued with the receipts
+# of its chunk, None marks the end of the range and an exception is passed
+# on to the main thread. Setting stopEvent ends the range after the current chunk
+def produceBlocks(begin_block, end_block, blockQueue, stopEvent):
+    try:
+        # Blocks are fetched in chunks of batchSize heights to save round-trips
+        for chunkStart in range(begin_block, end_block + 1, batchSize):
+            if stopEvent.is_set():
+                break
+            heights = range(chunkStart, min(chunkStart + batchSize, end_block + 1))
+            blocks, receiptsByHash = fetchBlocks(heights)
+            for block in blocks:
+                blockQueue.put((block, receiptsByHash))
+        blockQueue.put(None)
+    except Exception as e:
+        blockQueue.put(e)
+
+
+# Splits an ERC20 transfer input into its raw arguments: the padding of the
+# address, the address and the amount. The input is the selector followed by
+# two 32 bytes arguments, typical address argument if there is a contract involved:
+# 0000000000000000000000009f066b6ddc399dcbc7c596ad7d97b79247c85afb
+# The address is its last 20 bytes, the 12 bytes before should be zeros
+def decodeTransfer(inputinfo):
+    return inputinfo[4:16], inputinfo[16:36], inputinfo[36:68]
+
+
+# Adds all transactions from Ethereum block, with COPY when backfilling
+def insertTxsFromBlock(block, receiptsByHash, backfill):
     blockid = block["number"]
     time = block["timestamp"]
-    for txNumber in range(0, len(block.transactions)):
-        trans = block.transactions[txNumber]
-        transReceipt = web3.eth.getTransactionReceipt(trans["hash"])
+    rows = []
+    for trans in block.transactions:
+        if not isIndexedTx(trans):
+            continue
+        transReceipt = receiptsByHash[trans["hash"]]
         # Save also transaction status, should be null if pre byzantium blocks
-        status = bool(transReceipt["status"])
-        txhash = trans["hash"].hex()
+        status = (
+            bool(transReceipt["status"]) if transReceipt["status"] is not None else None
+        )
+        txhash = bytes(trans["hash"])
         value = trans["value"]
         inputinfo = trans["input"]
 
-        contract_to = ""
+        contract_to = b""
         contract_value = ""
         # Check if transaction is a contract transfer
-        if inputinfo.startswith("0xa9059cbb"):
-            # contract_to = inputinfo[10:-64]
-            # typical output if there is a contract involved:
-            # 0000000000000000000000009f066b6ddc399dcbc7c596ad7d97b79247c85afb
-            # We transform it by -1) taking the last 40 characters
-            # -2) adding 0x to the front
-            # Resulting hash should match the standard address (or contract) hash format
-            #
-            # contract_to = f'0x{contract_to[-40:]}'
-            # contract_value = inputinfo[74:]
-            contract_to = f"0x{inputinfo[-104 :-64]}"
-            contract_value = inputinfo[-64:]
-            if inputinfo[-128:-104] != "000000000000000000000000":
+        if inputinfo[:4] == transferSelector:
+            padding, contract_to, value_bytes = decodeTransfer(inputinfo)
+            contract_value = value_bytes.hex()
+            if padding != bytes(12):
                 logger.warning(
-                    f"Address input part doesnt have 24 leading zeros: {inputinfo[-128 :-104]}. Txhash: {txhash}"
+                    f"Address input part doesnt have 24 leading zeros: {padding.hex()}. Txhash: {txhash.hex()}"
                 )
 
-        if value == 0 and not inputinfo.startswith("0xa9059cbb"):
-            continue
         try:
             fr = trans["from"]
         except:
             logger.error(
-                f"Cannot get 'from' item from transaction. txhash : ({txhash})"
+                f"Cannot get 'from' item from transaction. txhash : ({txhash.hex()})"
             )
         try:
             to = trans["to"]
         except:
-            logger.error(f"Cannot get 'to' item from transaction.  txhash :({txhash})")
+            logger.error(f"Cannot get 'to' item from transaction.  txhash :({txhash.hex()})")
 
         gasprice = trans["gasPrice"]
         gas = transReceipt["gasUsed"]
 
-        cur.execute(
-            "INSERT INTO public.ethtxs(time, txfrom, txto, value, gas, gasprice, block, txhash, contract_to, contract_value, status) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        rows.append(
             (
                 time,
                 fr,
@@ -160,35 +429,147 @@ def insertTxsFromBlock(block):
                 contract_to,
                 contract_value,
                 status,
-            ),
+            )
         )
 
+    # All transactions of the block are sent to the database at once
+    if not rows:
+        return
+    if backfill:
+        copyTxs(rows)
+    else:
+        psycopg2.extras.execute_values(
+            cur,
+            insertTxsQuery,
+            rows,
+            page_size=1000,
+        )
+
+# COPY is the fastest way to load rows while backfilling far from the chain tip.
+# Bytes are written in the bytea hex format. Empty csv fields are NULL (txto of
+# contract creations, pre byzantium status), except contract_value that stores
+# "" for plain ETH transfers
+def copyTxs(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(
+            ["\\x" + v.hex() if isinstance(v, bytes) else v for v in row]
+        )
+    buf.seek(0)
+    cur.copy_expert(copyTxsQuery, buf)
+
+# Called at the start of every write transaction. While backfilling the
+# commits don't wait for the WAL flush: after a server crash the indexer
+# restarts from the best block really stored and syncs the lost blocks again
+def beginBlocksTransaction(backfill):
+    if backfill:
+        cur.execute("SET LOCAL synchronous_commit = off")
+
+# Runs in the current write transaction, which is committed only once the
+# deleted blocks are synced again. The range scan uses block_index
 def delete_last_blocks_from_db(begin_block, end_block):
     try:
-        cur.execute("DELETE from ethtxs CASCADE WHERE block > %s AND block <= %s", (begin_block, end_block))
+        cur.execute("DELETE FROM public.ethtxs WHERE block > %s AND block <= %s", (begin_block, end_block))
         logger.info(f'Deleted blocks {begin_block+1} to {end_block}')
-    except:
-        logger.error(f'Failed to delete blocks {begin_block+1} to {end_block}')
+    except Exception:
+        logger.exception(f'Failed to delete blocks {begin_block+1} to {end_block}')
+        raise
 
-latest_hash = ''
-# Fetch all of new (not in index) Ethereum blocks and add transactions to index
-while True:
+# Hashes of the last synced blocks by block number, to detect reorganisations
+# and find where the chain forked without fetching these blocks again
+recentBlocks = OrderedDict()
+# At least 20 hashes, so reorganisations are still detected with CONFIRMATIONS_BLOCK=0
+recentBlocksLimit = max(reorg_blocks, 10) * 2
+
+# Starts fetching blocks from begin_block to end_block in the background,
+# returns the queue they come in and the event that stops the producer
+def startProducer(begin_block, end_block):
+    blockQueue = Queue(maxsize=prefetchBlocks)
+    stopEvent = Event()
+    producer = Thread(
+        target=produceBlocks,
+        args=(begin_block, end_block, blockQueue, stopEvent),
+        daemon=True,
+    )
+    producer.start()
+    return blockQueue, stopEvent
+
+
+# Returns the last cached block which is still in the chain, or None if the
+# reorganisation is deeper than the cache
+def findForkBlock():
+    heights = list(recentBlocks)
+    rawBlocks = rpcBatch("eth_getBlockByNumber", [[hex(h), False] for h in heights])
+    for height, rawBlock in zip(reversed(heights), reversed(rawBlocks)):
+        if rawBlock is not None and HexBytes(rawBlock["hash"]) == recentBlocks[height]:
+            return height
+    return None
+
+
+# Block numbers of new heads announced by the node over websocket
+headQueue = Queue()
+
+# Subscribes to newHeads and queues their numbers. Runs in a background thread
+# with its own event loop and subscribes again if the connection drops
+def subscribeNewHeads():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    while True:
+        try:
+            loop.run_until_complete(receiveNewHeads())
+        except Exception as e:
+            logger.warning(f"newHeads subscription failed ({e}), subscribing again")
+            time.sleep(int(pollingPeriod))
+
+
+async def receiveNewHeads():
+    async with websockets.connect(nodeUrl) as ws:
+        await ws.send(
+            json.dumps(
+                {"jsonrpc": "2.0", "id": 1, "method": "eth_subscribe", "params": ["newHeads"]}
+            )
+        )
+        response = json.loads(await ws.recv())
+        if "error" in response:
+            raise ValueError(response["error"])
+        while True:
+            message = json.loads(await ws.recv())
+            headQueue.put(int(message["params"]["result"]["number"], 16))
+
+
+# Waits for the next sync. Over websocket it returns as soon as the node
+# announces a new head with the highest head number seen, otherwise (or if no
+# head comes within pollingPeriod) it returns None and the node is polled
+def waitForNewHead():
+    if not nodeUrl.startswith("ws"):
+        time.sleep(int(pollingPeriod))
+        return None
     try:
-        pg_connection_dict = {"dbname": dbname, "user": username, "password": userpass}
-        conn = psycopg2.connect(**pg_connection_dict)
-        conn.autocommit = True
-    except:
-        logger.error("Unable to connect to database")
+        latestHead = headQueue.get(timeout=int(pollingPeriod))
+    except Empty:
+        return None
+    while not headQueue.empty():
+        latestHead = max(latestHead, headQueue.get())
+    return latestHead
 
-    cur = conn.cursor()
 
-    cur.execute("SELECT Max(block) from public.ethtxs")
-    maxblockindb = cur.fetchone()[0]
-    # On first start, we index transactions from a block number you indicate
-    if maxblockindb is None:
-        maxblockindb = int(startBlock)
+if nodeUrl.startswith("ws"):
+    Thread(target=subscribeNewHeads, daemon=True).start()
 
-    endblock = int(web3.eth.blockNumber) - int(confirmationBlocks)
+latestHead = None
+# Fetch all of new (not in index) Ethereum blocks and add transactions to index
+while True:
+    conn, reconnected = getLiveConnection()
+    cur = conn.cursor()
+    if reconnected:
+        # Backfill commits made with synchronous_commit off may have been lost
+        # if the server crashed, so the cached best block can't be trusted
+        maxblockindb = readMaxBlockInDb(cur)
+
+    if latestHead is None:
+        latestHead = web3.eth.blockNumber
+    endblock = int(latestHead) - int(confirmationBlocks)
 
     logger.info(
         "Current best block in index: "
@@ -199,17 +580,43 @@ while True:
 
 
 
-    for blockHeight in range(maxblockindb + 1, endblock+1):
-        block = web3.eth.getBlock(blockHeight, True)
-        if blockHeight == endblock:
-            if latest_hash != block['parentHash'].hex():
-                # then we have to delete the lastest x blocks
-                logger.warning(f'Reorganisation!: Lastest hash is not the same as the newest ParentHash')
-                delete_last_blocks_from_db(blockHeight-1-reorg_blocks, blockHeight-1)
-                continue
+    blockQueue, stopEvent = startProducer(maxblockindb + 1, endblock)
+    beginBlocksTransaction(endblock - maxblockindb > backfillThreshold)
+    # Last block deleted by a reorganisation, the transaction is not committed
+    # before it is synced again
+    resyncUntil = 0
+    while True:
+        item = blockQueue.get()
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+        block, receiptsByHash = item
+        blockHeight = block["number"]
+        # Far from the tip use COPY, switch back to INSERT when catching up
+        backfill = endblock - blockHeight > backfillThreshold
+        parentHash = recentBlocks.get(blockHeight - 1)
+        if parentHash is not None and parentHash != block['parentHash']:
+            logger.warning(f'Reorganisation!: Lastest hash is not the same as the newest ParentHash')
+            # Drop the prefetched blocks and wait for the producer to finish,
+            # so the node provider is not used by both threads at once
+            stopEvent.set()
+            while item is not None and not isinstance(item, Exception):
+                item = blockQueue.get()
+            forkBlock = findForkBlock()
+            if forkBlock is None:
+                # then we have to delete all the cached blocks
+                forkBlock = next(iter(recentBlocks)) - 1
+            delete_last_blocks_from_db(forkBlock, blockHeight-1)
+            resyncUntil = blockHeight-1
+            for height in [h for h in recentBlocks if h > forkBlock]:
+                del recentBlocks[height]
+            # Sync again from the fork
+            blockQueue, stopEvent = startProducer(forkBlock + 1, endblock)
+            continue
 
         if len(block.transactions) > 0:
-            insertTxsFromBlock(block)
+            insertTxsFromBlock(block, receiptsByHash, backfill)
             logger.info(
                 "Block "
                 + str(blockHeight)
@@ -219,7 +626,15 @@ while True:
             )
         else:
             logger.info("Block " + str(blockHeight) + " does not contain transactions")
-        latest_hash = block['hash'].hex()
+        recentBlocks[blockHeight] = block['hash']
+        if len(recentBlocks) > recentBlocksLimit:
+            recentBlocks.popitem(last=False)
+        # Each batchSize blocks are written in one transaction
+        if (blockHeight - maxblockindb) % batchSize == 0 and blockHeight > resyncUntil:
+            conn.commit()
+            beginBlocksTransaction(backfill)
+    conn.commit()
+    maxblockindb = max(maxblockindb, endblock)
     cur.close()
-    conn.close()
-    time.sleep(int(pollingPeriod))
+    pool.putconn(conn)
+    latestHead = waitForNewHead()
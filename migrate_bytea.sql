@@ -0,0 +1,39 @@
+-- Converts an index created with citext hashes and addresses to bytea columns.
+-- Stop the indexer before running it:
+-- psql -U api_user -f migrate_bytea.sql index
+
+BEGIN;
+
+-- These indexes are declared with a collation, which bytea doesn't support
+DROP INDEX public.contract_to_index;
+DROP INDEX public.txfrom_index;
+DROP INDEX public.txto_index;
+
+ALTER TABLE public.ethtxs
+    ALTER COLUMN txfrom TYPE bytea USING decode(substr(txfrom::text, 3), 'hex'),
+    ALTER COLUMN txto TYPE bytea USING decode(substr(txto::text, 3), 'hex'),
+    ALTER COLUMN txhash TYPE bytea USING decode(substr(txhash::text, 3), 'hex'),
+    -- Old versions stored malformed values like '0x0xa9059cbb…' for transfer
+    -- calls with short input, these have no recipient and become NULL
+    ALTER COLUMN contract_to TYPE bytea USING
+        CASE WHEN contract_to = '' THEN '\x'::bytea
+        WHEN contract_to::text ~ '^0x([0-9a-fA-F]{2})*$'
+            THEN decode(substr(contract_to::text, 3), 'hex')
+        ELSE NULL END;
+
+CREATE INDEX contract_to_index
+    ON public.ethtxs USING btree
+    (contract_to)
+    TABLESPACE pg_default;
+
+CREATE INDEX txfrom_index
+    ON public.ethtxs USING btree
+    (txfrom)
+    TABLESPACE pg_default;
+
+CREATE INDEX txto_index
+    ON public.ethtxs USING btree
+    (txto)
+    TABLESPACE pg_default;
+
+COMMIT;